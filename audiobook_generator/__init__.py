@@ -0,0 +1,26 @@
+"""
+Audiobook Generator - Converts EPUB files to audio using Kokoro TTS
+"""
+from .core import (
+    BACKENDS,
+    DEVICES,
+    OUTPUT_FORMATS,
+    Chapter,
+    extract_chapters_from_epub,
+    generate_audiobook,
+    get_book_metadata,
+    save_audiobook_as_m4b,
+    test_audio,
+)
+
+__all__ = [
+    'BACKENDS',
+    'DEVICES',
+    'OUTPUT_FORMATS',
+    'Chapter',
+    'extract_chapters_from_epub',
+    'generate_audiobook',
+    'get_book_metadata',
+    'save_audiobook_as_m4b',
+    'test_audio',
+]
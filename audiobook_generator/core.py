@@ -0,0 +1,794 @@
+"""
+Core audiobook generation: EPUB parsing, Kokoro TTS and audio encoding
+"""
+import os
+
+# Let ops MPS lacks fall back to the CPU instead of raising; torch reads
+# this when it loads, so it has to be set before kokoro imports it
+os.environ.setdefault('PYTORCH_ENABLE_MPS_FALLBACK', '1')
+
+from kokoro import KPipeline
+import soundfile as sf
+import sounddevice as sd
+from ebooklib import epub, ITEM_DOCUMENT
+from bs4 import BeautifulSoup, SoupStrainer
+from dataclasses import dataclass
+import functools
+import hashlib
+import json
+import re
+import queue
+import threading
+import subprocess
+import tempfile
+import numpy as np
+import torch
+
+# TTS backends accepted by generate_audiobook
+BACKENDS = ('torch', 'onnx-int8')
+
+# Torch devices accepted by generate_audiobook (None picks the fastest available)
+DEVICES = ('cuda', 'mps', 'cpu')
+
+# Output layouts accepted by generate_audiobook
+OUTPUT_FORMATS = ('m4b', 'wav')
+
+# Mixed-precision dtype per accelerator; CPU inference stays in float32
+AUTOCAST_DTYPES = {'cuda': torch.float16, 'mps': torch.bfloat16}
+
+# Only the parts of a chapter document that carry readable text or its title
+_CHAPTER_STRAINER = SoupStrainer(['body', 'p', 'h1', 'h2', 'h3', 'div', 'span'])
+_WS_RE = re.compile(r'\n\s*\n')
+_PARAGRAPH_RE = re.compile(r'\n\n+')
+# Splitting on sentences instead bounds time-to-first-audio when playing live
+_SENTENCE_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Characters of text per synthesize_batched window, which bounds the audio held before yielding
+WINDOW_CHARS = 2000
+
+# AAC encoder passed to ffmpeg. Set to 'libfdk_aac' if your ffmpeg build
+# includes it; it encodes noticeably faster than the native encoder.
+AAC_ENCODER = 'aac'
+
+
+@dataclass
+class Chapter:
+    """A chapter's plain-text content, detached from the parsed EPUB."""
+    number: int
+    title: str
+    text: str
+
+
+def get_book_metadata(book):
+    """
+    Extract metadata from an EPUB book.
+    
+    Args:
+        book: EpubBook returned by epub.read_epub
+        
+    Returns:
+        Dictionary with metadata (title, author, etc.)
+    """
+    metadata = {
+        'title': book.get_metadata('DC', 'title')[0][0] if book.get_metadata('DC', 'title') else 'Unknown Title',
+        'author': book.get_metadata('DC', 'creator')[0][0] if book.get_metadata('DC', 'creator') else 'Unknown Author',
+        'publisher': book.get_metadata('DC', 'publisher')[0][0] if book.get_metadata('DC', 'publisher') else '',
+        'date': book.get_metadata('DC', 'date')[0][0] if book.get_metadata('DC', 'date') else '',
+        'language': book.get_metadata('DC', 'language')[0][0] if book.get_metadata('DC', 'language') else 'en',
+    }
+    
+    return metadata
+
+
+def extract_chapters_from_epub(book):
+    """
+    Extract chapters from an EPUB book.
+    
+    Args:
+        book: EpubBook returned by epub.read_epub
+        
+    Returns:
+        List of Chapter objects
+    """
+    chapters = []
+    
+    chapter_num = 0
+    for item in book.get_items():
+        if item.get_type() == ITEM_DOCUMENT:
+            # Parse HTML content
+            soup = BeautifulSoup(item.get_content(), 'lxml', parse_only=_CHAPTER_STRAINER)
+            
+            # Extract text. Not get_text(separator, strip=True): that puts
+            # inline tags (<em>, <a>) on their own lines and drops the blank
+            # lines between paragraphs that _PARAGRAPH_RE splits on.
+            text = soup.get_text()
+            
+            # Clean up text - remove excessive whitespace in one regex pass
+            text = _WS_RE.sub('\n\n', text).strip()
+            
+            # Skip empty chapters
+            if not text or len(text) < 50:
+                soup.decompose()
+                continue
+            
+            # Try to get chapter title
+            title = item.get_name()
+            h1 = soup.find(['h1', 'h2', 'h3'])
+            if h1:
+                title = h1.get_text().strip()
+            
+            # Free the parse tree now rather than when the loop rebinds soup
+            soup.decompose()
+            
+            chapter_num += 1
+            chapters.append(Chapter(chapter_num, title, text))
+            print(f"Extracted Chapter {chapter_num}: {title}")
+    
+    return chapters
+
+
+def _ffmetadata_escape(value):
+    """Escape a value for ffmpeg's FFMETADATA1 format."""
+    return re.sub(r'([=;#\\\n])', r'\\\1', str(value))
+
+
+def save_audiobook_as_m4b(chapter_files, output_file, metadata):
+    """
+    Encode chapter WAV files into a single M4B with chapter markers.
+    
+    All chapters go through one ffmpeg invocation using the concat demuxer,
+    so the AAC encoder is only initialized once for the whole book. Tags are
+    written by ffmpeg during muxing, so the file is never reopened to retag.
+    
+    Args:
+        chapter_files: List of tuples (wav_path, chapter_title, num_samples) in playback order
+        output_file: Path to output M4B file
+        metadata: Dictionary containing book metadata (title, author, etc.)
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # Input list for the concat demuxer
+        list_path = os.path.join(temp_dir, 'chapters.txt')
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for wav_path, _, _ in chapter_files:
+                escaped = os.path.abspath(wav_path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+        
+        # Chapter markers, timed in samples
+        meta_path = os.path.join(temp_dir, 'metadata.txt')
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            f.write(';FFMETADATA1\n')
+            start = 0
+            for _, title, num_samples in chapter_files:
+                f.write('[CHAPTER]\nTIMEBASE=1/24000\n')
+                f.write(f'START={start}\nEND={start + num_samples}\n')
+                f.write(f'title={_ffmetadata_escape(title)}\n')
+                start += num_samples
+        
+        # Book tags go straight into the ffmpeg mux; media_type=2 is the iTunes audiobook flag (stik)
+        tags = {
+            'title': metadata.get('title'),
+            'album': metadata.get('title'),
+            'artist': metadata.get('author'),
+            'album_artist': metadata.get('author'),
+            'genre': metadata.get('genre'),
+            'date': metadata.get('date'),
+            'comment': metadata.get('comment'),
+            'media_type': 2,
+        }
+        tag_args = []
+        for key, value in tags.items():
+            if value:
+                tag_args += ['-metadata', f'{key}={value}']
+        
+        result = subprocess.run(
+            [
+                'ffmpeg', '-y', '-loglevel', 'error',
+                '-f', 'concat', '-safe', '0', '-i', list_path,
+                '-i', meta_path,
+                '-map', '0:a', '-map_metadata', '1', '-map_chapters', '1',
+                *tag_args,
+                '-c:a', AAC_ENCODER,
+                '-b:a', '64k',  # Good quality for spoken word
+                '-f', 'ipod',  # iPod format creates M4A/M4B compatible files
+                output_file,
+            ],
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed encoding {output_file}: {result.stderr.decode(errors='replace').strip()}")
+
+
+def _default_device():
+    """Pick the fastest available torch device: CUDA, then Apple MPS, then CPU."""
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+
+def _in_float32(fn):
+    """Wrap fn so it always runs outside autocast on float32 inputs."""
+    @functools.wraps(fn)
+    def wrapper(*args):
+        with torch.autocast(args[0].device.type, enabled=False):
+            return fn(*(arg.float() for arg in args))
+    return wrapper
+
+
+class OnnxPipeline:
+    """
+    KPipeline stand-in that runs the int8-quantized ONNX export of Kokoro on CPU.
+    
+    Text is split like synthesize_batched; G2P, 510 phoneme chunking and
+    voice packs come from a model-less KPipeline, and only the forward pass
+    goes through ONNX Runtime. Calling it yields the same
+    (graphemes, phonemes, audio) tuples as a KPipeline.
+    """
+    
+    REPO_ID = 'onnx-community/Kokoro-82M-v1.0-ONNX'
+    MODEL_FILE = 'onnx/model_quantized.onnx'
+    
+    def __init__(self, lang_code, model_path=None):
+        """
+        Args:
+            lang_code: Kokoro language code (e.g. 'a' for American English)
+            model_path: Path to a local ONNX model; downloaded from HF if omitted
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The onnx-int8 backend needs onnxruntime: uv sync --extra onnx") from e
+        # Installed with kokoro, which fetches its own weights the same way
+        from huggingface_hub import hf_hub_download
+        
+        self.pipeline = KPipeline(lang_code=lang_code, model=False)
+        with open(hf_hub_download(repo_id='hexgrad/Kokoro-82M', filename='config.json'), encoding='utf-8') as f:
+            self.vocab = json.load(f)['vocab']
+        
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = os.cpu_count()
+        self.session = ort.InferenceSession(
+            model_path or hf_hub_download(repo_id=self.REPO_ID, filename=self.MODEL_FILE),
+            sess_options=so,
+            providers=['CPUExecutionProvider'],
+        )
+    
+    def __call__(self, text, voice, speed=1, split_pattern=r'\n+'):
+        pack = self.pipeline.load_voice(voice).numpy()
+        # Split like synthesize_batched, so no chapter reaches G2P in one call
+        segments = (segment for part in _split_text(text, split_pattern)
+                    for segment in self.pipeline(part, voice=voice, speed=speed, split_pattern=None))
+        for gs, ps, _ in segments:
+            input_ids = [0, *(self.vocab[p] for p in ps if p in self.vocab), 0]
+            audio = self.session.run(None, {
+                'input_ids': np.array([input_ids], dtype=np.int64),
+                'style': pack[len(ps) - 1],
+                'speed': np.array([speed], dtype=np.float32),
+            })[0]
+            yield gs, ps, audio.reshape(-1)
+
+
+def _get_pipeline(lang_code, backend='torch', device=None, compile_model=False):
+    """
+    Return a shared KPipeline for lang_code, loading the model on first use.
+    
+    On accelerators the harmonic source and STFT stages of the vocoder are
+    pinned to float32, since sine phase accumulation and the FFTs lose too
+    much precision under half-precision autocast.
+    
+    Args:
+        lang_code: Kokoro language code (e.g. 'a' for American English)
+        backend: One of BACKENDS; 'onnx-int8' returns an OnnxPipeline
+        device: One of DEVICES, or None for the fastest available
+            (ignored by 'onnx-int8', which runs on the CPU)
+        compile_model: Whether to torch.compile the decoder, which dominates
+            inference time (pays a one-off compile cost per process)
+        
+    Returns:
+        KPipeline (or OnnxPipeline) instance reused for the lifetime of the process
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    if backend == 'onnx-int8':
+        device, compile_model = 'cpu', False
+    elif device is None:
+        device = _default_device()
+    elif device not in DEVICES:
+        raise ValueError(f"Unknown device {device!r}, expected one of {DEVICES}")
+    # Normalised arguments passed positionally, so every call site shares one cache entry
+    return _load_pipeline(lang_code, backend, device, bool(compile_model))
+
+
+@functools.lru_cache(maxsize=4)
+def _load_pipeline(lang_code, backend, device, compile_model):
+    if backend == 'onnx-int8':
+        return OnnxPipeline(lang_code)
+    
+    pipeline = KPipeline(lang_code=lang_code, device=device)
+    if device in AUTOCAST_DTYPES:
+        generator = pipeline.model.decoder.generator
+        generator.m_source.forward = _in_float32(generator.m_source.forward)
+        generator.stft.transform = _in_float32(generator.stft.transform)
+        generator.stft.inverse = _in_float32(generator.stft.inverse)
+    if compile_model:
+        pipeline.model.decoder = torch.compile(pipeline.model.decoder, dynamic=True)
+    return pipeline
+
+
+@functools.lru_cache(maxsize=16)
+def _get_voice_pack(pipeline, voice):
+    """
+    Return the voice pack for voice, already moved to the pipeline's model device.
+    
+    Args:
+        pipeline: KPipeline instance with a loaded model
+        voice: Voice name (or comma-separated blend)
+        
+    Returns:
+        Voice pack tensor indexed by phoneme count
+    """
+    return pipeline.load_voice(voice).to(pipeline.model.device)
+
+
+@torch.inference_mode()
+def _forward_batch(model, phonemes, ref_s, speed=1):
+    """
+    Run a window of phoneme strings through Kokoro.
+    
+    Each string goes through KModel.forward_with_tokens on its own. The
+    decoder, which dominates inference time, normalises over time (AdaIN)
+    and runs an unpacked bidirectional LSTM in F0Ntrain, so a padded batch
+    would change the audio of every shorter sample. Runs under autocast on
+    CUDA (float16) and MPS (bfloat16).
+    
+    Args:
+        model: KModel instance
+        phonemes: List of phoneme strings (each at most 510 characters)
+        ref_s: Voice style vectors, one row per phoneme string
+        speed: Speech speed
+        
+    Returns:
+        List of float32 numpy arrays, one per phoneme string (views into one window buffer)
+    """
+    device = model.device
+    audio = []
+    with torch.autocast(device.type, dtype=AUTOCAST_DTYPES.get(device.type, torch.bfloat16),
+                        enabled=device.type in AUTOCAST_DTYPES):
+        for ps, style in zip(phonemes, ref_s.to(device)):
+            input_ids = torch.LongTensor([[0, *(model.vocab[p] for p in ps if p in model.vocab), 0]])
+            segment_audio, _ = model.forward_with_tokens(input_ids.to(device), style.unsqueeze(0), speed)
+            audio.append(segment_audio.reshape(-1))
+    # One device-to-host copy for the whole window; each segment is a view into it
+    lengths = [len(a) for a in audio]
+    audio = torch.cat(audio).float().cpu().numpy()
+    return np.split(audio, np.cumsum(lengths)[:-1])
+
+
+def _split_text(text, split_pattern, window_chars=WINDOW_CHARS):
+    """
+    Yield the non-blank paragraphs (or sentences) of text for G2P.
+    
+    Paragraphs longer than window_chars are also split on line breaks,
+    since XHTML text often has no blank lines between paragraphs.
+    """
+    for paragraph in re.split(split_pattern, text.strip()):
+        for part in (paragraph.split('\n') if len(paragraph) > window_chars else [paragraph]):
+            if part.strip():
+                yield part
+
+
+def synthesize_batched(pipeline, text, voice='af_heart', speed=1, batch_size=8, split_pattern=_PARAGRAPH_RE,
+                       window_chars=WINDOW_CHARS, flush_first=False):
+    """
+    Generate audio for text in bounded windows of Kokoro segments.
+    
+    The text is split into paragraphs (or sentences), each phonemized exactly
+    like KPipeline (510 phoneme chunking). Segments are collected into a
+    window that is inferred and yielded as soon as it holds batch_size
+    segments or window_chars characters of text, so peak memory is bounded
+    by one window however the chapter is laid out. Text is split with
+    _split_text, so over-long paragraphs are also split on line breaks.
+    
+    Args:
+        pipeline: English KPipeline instance with a loaded model
+        text: Text to synthesize
+        voice: Voice to use for TTS
+        speed: Speech speed
+        batch_size: Maximum number of segments per window
+        split_pattern: Regex used to split text into paragraphs (or sentences)
+        window_chars: Maximum characters of text per window
+        flush_first: Yield the first segment as a window of its own, so live
+            playback can start without waiting for a full window
+        
+    Yields:
+        Tuples (graphemes, phonemes, audio) in text order
+    """
+    pack = _get_voice_pack(pipeline, voice)
+    window = []
+    window_len = 0
+    window_size = 1 if flush_first else batch_size
+    for part in _split_text(text, split_pattern, window_chars):
+        _, tokens = pipeline.g2p(part)
+        for gs, ps, _ in pipeline.en_tokenize(tokens):
+            if not ps:
+                continue
+            window.append((gs, ps[:510]))
+            window_len += len(gs)
+            if len(window) >= window_size or window_len >= window_chars:
+                yield from _synthesize_window(pipeline, pack, window, speed)
+                window = []
+                window_len = 0
+                window_size = batch_size
+    if window:
+        yield from _synthesize_window(pipeline, pack, window, speed)
+
+
+def _synthesize_window(pipeline, pack, window, speed):
+    """Infer one window of (graphemes, phonemes) segments with _forward_batch."""
+    phonemes = [ps for _, ps in window]
+    ref_s = torch.stack([pack[len(ps) - 1] for ps in phonemes]).squeeze(1)
+    for (gs, ps), audio in zip(window, _forward_batch(pipeline.model, phonemes, ref_s, speed)):
+        yield gs, ps, audio
+
+
+def _to_int16(audio):
+    """
+    Convert float samples in [-1, 1] to clipped int16 PCM.
+    
+    Scales and clips in place, so the only new allocation is the int16
+    result. The float input must not be used afterwards.
+    """
+    audio = np.asarray(audio, dtype=np.float32)
+    np.multiply(audio, 32767.0, out=audio)
+    np.clip(audio, -32768, 32767, out=audio)
+    return audio.astype(np.int16)
+
+
+class AudioPlayer:
+    """
+    Gapless playback of int16 segments on a background sounddevice stream.
+    
+    play() only queues the audio, so synthesis can run ahead of playback;
+    the stream callback pulls queued segments as the device needs frames.
+    At most max_segments are held, after which play() blocks until the
+    device catches up, so a long book is never buffered in memory.
+    """
+    
+    def __init__(self, samplerate=24000, max_segments=16):
+        self._segments = queue.Queue(maxsize=max_segments)
+        self._current = None
+        self._offset = 0
+        self._stream = sd.OutputStream(samplerate=samplerate, channels=1, dtype='int16',
+                                       callback=self._callback)
+        self._stream.start()
+    
+    def play(self, audio):
+        """Queue an int16 segment for playback, blocking only while the queue is full."""
+        self._segments.put(audio)
+    
+    def close(self):
+        """Wait for all queued audio to finish playing, then close the stream."""
+        self._segments.join()
+        self._stream.stop()  # stop() lets the device drain buffers already handed over
+        self._stream.close()
+    
+    def _callback(self, outdata, frames, time, status):
+        written = 0
+        while written < frames:
+            if self._current is None:
+                try:
+                    self._current = self._segments.get_nowait()
+                except queue.Empty:
+                    break
+                self._offset = 0
+            n = min(frames - written, len(self._current) - self._offset)
+            outdata[written:written + n, 0] = self._current[self._offset:self._offset + n]
+            written += n
+            self._offset += n
+            if self._offset >= len(self._current):
+                self._current = None
+                self._segments.task_done()
+        # Underrun: pad with silence until the next segment arrives
+        outdata[written:] = 0
+
+
+def synthesize_chapters(pipeline, chapters, audio_queue, voice='af_heart', speed=1, play_audio=False,
+                        batch_size=8, stop=None, split_pattern=_PARAGRAPH_RE):
+    """
+    Run TTS over each chapter and hand each segment to the writer stage.
+    
+    Runs on its own thread so Kokoro inference overlaps with disk writes.
+    Every chapter ends with a (chapter_num, title, None) marker, and a None
+    sentinel is always pushed last, even on failure, so the consumer never
+    blocks forever. Setting stop makes it give up after the current segment.
+    
+    Args:
+        pipeline: KPipeline or OnnxPipeline instance shared by all chapters
+        chapters: List of Chapter objects
+        audio_queue: Bounded queue receiving (chapter_num, title, audio) tuples, audio as int16
+        voice: Voice to use for TTS
+        speed: Speech speed
+        play_audio: Whether to play audio as it's generated (synthesis runs ahead of
+            playback by up to AudioPlayer's queue); each chapter's first segment
+            is then synthesized on its own so playback starts right away
+        batch_size: Maximum number of segments synthesized per window
+        stop: Optional threading.Event the consumer sets when it stops reading
+        split_pattern: Regex used to split chapter text into paragraphs (or sentences)
+    """
+    player = None
+    try:
+        if play_audio:
+            player = AudioPlayer()
+        for chapter in chapters:
+            chapter_num, title, text = chapter.number, chapter.title, chapter.text
+            print(f"\n{'='*60}")
+            print(f"Processing Chapter {chapter_num}: {title}")
+            print(f"{'='*60}")
+            print(f"Text length: {len(text)} characters")
+            
+            # Generate audio for this chapter
+            if isinstance(pipeline, OnnxPipeline):
+                generator = pipeline(text, voice=voice, speed=speed, split_pattern=split_pattern)
+            else:
+                generator = synthesize_batched(pipeline, text, voice=voice, speed=speed, batch_size=batch_size,
+                                               split_pattern=split_pattern, flush_first=play_audio)
+            
+            for i, (gs, ps, audio) in enumerate(generator):
+                if stop is not None and stop.is_set():
+                    return
+                print(f"  Segment {i}: {len(audio)} samples")
+                # 16-bit is plenty for 64k AAC speech and halves bytes through the writer
+                audio = _to_int16(audio)
+                audio_queue.put((chapter_num, title, audio))
+                
+                if player is not None:
+                    player.play(audio)
+            
+            audio_queue.put((chapter_num, title, None))
+    finally:
+        audio_queue.put(None)
+        if player is not None:
+            player.close()
+
+
+def write_chapter_wavs(audio_queue, output_dir):
+    """
+    Stream segments from the TTS stage into one WAV file per chapter.
+    
+    Segments are written as they arrive, so memory use is bounded by the
+    queue rather than by the length of a chapter. Each chapter is written to
+    a .part file and only renamed into place once complete, so an
+    interrupted run never leaves a truncated chapter_NN.wav behind.
+    
+    Args:
+        audio_queue: Queue fed by synthesize_chapters
+        output_dir: Directory to write chapter_NN.wav files into
+        
+    Yields:
+        Tuples (chapter_num, wav_path, chapter_title, num_samples) as each chapter completes
+    """
+    # State of the chapter being written; wav is None between chapters
+    wav = None
+    wav_path = part_path = None
+    num_samples = 0
+    try:
+        while True:
+            item = audio_queue.get()
+            if item is None:
+                break
+            chapter_num, title, audio = item
+            
+            if audio is None:
+                # End of chapter
+                if wav is not None:
+                    wav.close()
+                    wav = None
+                    os.replace(part_path, wav_path)
+                    print(f"Saved: {wav_path}")
+                    yield chapter_num, wav_path, f"Chapter {chapter_num}: {title}", num_samples
+                continue
+            
+            if wav is None:
+                wav_path = _chapter_wav_path(output_dir, chapter_num)
+                part_path = wav_path + '.part'
+                wav = sf.SoundFile(part_path, 'w', 24000, 1, 'PCM_16', format='WAV')
+                num_samples = 0
+            wav.write(audio)
+            num_samples += len(audio)
+    finally:
+        if wav is not None:
+            wav.close()
+
+
+def _chapter_wav_path(output_dir, chapter_num):
+    return os.path.join(output_dir, f"chapter_{chapter_num:02d}.wav")
+
+
+def _chapter_hash(text, voice, speed, backend, split_pattern):
+    """Fingerprint everything that changes a chapter's audio, for resume checks."""
+    key = f"{voice}\0{speed}\0{backend}\0{split_pattern.pattern}\0{text}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def _book_hash(chapters, chapter_hashes, tags):
+    """Fingerprint everything that changes the encoded M4B: chapter audio, titles, tags and encoder."""
+    contents = [AAC_ENCODER, tags, [(c.title, chapter_hashes[c.number]) for c in chapters]]
+    return hashlib.sha256(json.dumps(contents, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(manifest_path, manifest):
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def generate_audiobook(epub_path, output_dir="audiobooks", voice='af_heart', speed=1, play_audio=False,
+                       batch_size=8, backend='torch', compile_model=False, output_format='m4b', device=None):
+    """
+    Generate audiobook from EPUB file.
+    
+    TTS and disk writes run as a two-stage pipeline: a producer thread
+    synthesizes segments into a bounded queue while this thread streams them
+    into per-chapter WAV files. For M4B output the chapter WAVs are then
+    encoded in a single pass into one M4B with chapter markers; for WAV
+    output they are the final result.
+    
+    Runs are resumable: finished chapter WAVs are recorded in
+    output_dir/.manifest.json with a hash of their text and TTS settings,
+    and chapters whose WAV and hash still match are not synthesized again.
+    A finished book.m4b is recorded the same way, so rerunning with
+    unchanged chapters and settings does nothing.
+    
+    Args:
+        epub_path: Path to the EPUB file
+        output_dir: Directory to save audio files
+        voice: Voice to use for TTS
+        speed: Speech speed
+        play_audio: Whether to play audio as it's generated (text is then split
+            per sentence, so chapters saved without it are synthesized again)
+        batch_size: Maximum number of text segments synthesized per window
+        backend: TTS backend, 'torch' or 'onnx-int8' (CPU-only)
+        compile_model: Whether to torch.compile the Kokoro decoder (worth it for long books)
+        output_format: 'm4b' for a single chaptered book file, 'wav' for one WAV per chapter
+        device: Torch device ('cuda', 'mps' or 'cpu'); the fastest available if omitted
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {OUTPUT_FORMATS}")
+    
+    # Create output directory
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Extract book metadata
+    print(f"Reading EPUB file: {epub_path}")
+    book = epub.read_epub(epub_path)
+    book_metadata = get_book_metadata(book)
+    print(f"Book: {book_metadata['title']} by {book_metadata['author']}")
+    
+    # Extract chapters
+    chapters = extract_chapters_from_epub(book)
+    print(f"\nFound {len(chapters)} chapters\n")
+    
+    # Chapters hold plain strings, so the EPUB's raw documents can go
+    del book
+    
+    manifest_path = os.path.join(output_dir, '.manifest.json')
+    manifest = _load_manifest(manifest_path)
+    # Live playback splits on sentences so audio starts sooner; the split is
+    # part of each chapter's hash because it changes how the audio is phrased
+    split_pattern = _SENTENCE_RE if play_audio else _PARAGRAPH_RE
+    chapter_hashes = {chapter.number: _chapter_hash(chapter.text, voice, speed, backend, split_pattern)
+                      for chapter in chapters}
+    
+    # Skip the whole book if a previous run already encoded it from the same chapters and settings
+    book_file = os.path.join(output_dir, "book.m4b")
+    book_tags = {
+        'title': book_metadata['title'],
+        'author': book_metadata['author'],
+        'genre': 'Audiobook',
+        'date': book_metadata['date'],
+        'comment': f"Generated with Kokoro TTS"
+    }
+    book_hash = _book_hash(chapters, chapter_hashes, book_tags)
+    entry = manifest.get(os.path.basename(book_file))
+    if output_format == 'm4b' and entry and entry['hash'] == book_hash and os.path.exists(book_file):
+        print(f"Skipping: {book_file} (already generated)")
+        return
+    
+    # Skip chapters finished by a previous run with the same text and settings
+    chapter_files = {}
+    remaining = []
+    for chapter in chapters:
+        wav_path = _chapter_wav_path(output_dir, chapter.number)
+        entry = manifest.get(os.path.basename(wav_path))
+        if (entry and entry['hash'] == chapter_hashes[chapter.number]
+                and os.path.exists(wav_path) and os.path.getsize(wav_path) > 1024):
+            print(f"Skipping Chapter {chapter.number}: {chapter.title} (already generated)")
+            chapter_files[chapter.number] = (wav_path, f"Chapter {chapter.number}: {chapter.title}",
+                                             entry['num_samples'])
+        else:
+            remaining.append(chapter)
+    
+    if remaining:
+        # Initialize TTS pipeline
+        pipeline = _get_pipeline('a', backend=backend, device=device, compile_model=compile_model)
+        
+        # Let TTS run up to two batches ahead of the writer
+        audio_queue = queue.Queue(maxsize=2 * batch_size)
+        stop = threading.Event()
+        producer_errors = []
+        
+        def produce():
+            try:
+                synthesize_chapters(pipeline, remaining, audio_queue, voice=voice, speed=speed,
+                                    play_audio=play_audio, batch_size=batch_size, stop=stop,
+                                    split_pattern=split_pattern)
+            except BaseException as e:
+                producer_errors.append(e)
+        
+        producer = threading.Thread(target=produce, name='tts-producer', daemon=True)
+        producer.start()
+        try:
+            for chapter_num, wav_path, title, num_samples in write_chapter_wavs(audio_queue, output_dir):
+                chapter_files[chapter_num] = (wav_path, title, num_samples)
+                manifest[os.path.basename(wav_path)] = {
+                    'hash': chapter_hashes[chapter_num],
+                    'num_samples': num_samples,
+                }
+                _save_manifest(manifest_path, manifest)
+        finally:
+            # If the writer failed, stop the producer and drain the queue so
+            # none of its puts (including the final sentinel) block forever
+            stop.set()
+            while producer.is_alive():
+                try:
+                    audio_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+        if producer_errors:
+            raise producer_errors[0]
+    
+    chapter_files = [chapter_files[n] for n in sorted(chapter_files)]
+    if chapter_files and output_format == 'm4b':
+        print(f"\nEncoding {len(chapter_files)} chapters to M4B format...")
+        save_audiobook_as_m4b(chapter_files, book_file, book_tags)
+        print(f"Saved: {book_file}")
+        
+        # The chapter WAVs are only intermediates for the book encode; the
+        # manifest now records just the book so a rerun can skip it
+        for wav_path, _, _ in chapter_files:
+            os.remove(wav_path)
+        _save_manifest(manifest_path, {os.path.basename(book_file): {'hash': book_hash}})
+    
+    print(f"\n{'='*60}")
+    print(f"Audiobook generation complete!")
+    print(f"Output directory: {output_dir}")
+    print(f"{'='*60}")
+
+
+def test_audio(device=None):
+    """Play a short passage through the default output device as a TTS smoke test."""
+    text = '''
+      "I hope you come here good-humouredly determined to make the best of your
+      position,” continued the lady. “You will have to begin this morning by
+      putting up with no other company at breakfast than mine. My sister is in
+      her own room, nursing that essentially feminine malady, a slight headache;"
+    '''
+    pipeline = _get_pipeline('a', device=device)
+    generator = pipeline(text, voice='af_heart', speed=1, split_pattern=_SENTENCE_RE)
+    player = AudioPlayer()
+    try:
+        for i, (gs, ps, audio) in enumerate(generator):
+            print(f"  Segment {i}: {len(audio)} samples")
+            player.play(_to_int16(audio))
+    finally:
+        player.close()
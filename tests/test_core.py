@@ -0,0 +1,156 @@
+import queue
+import threading
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+kokoro = pytest.importorskip('kokoro')
+try:
+    import sounddevice as sd
+except (ImportError, OSError) as e:
+    # Without the PortAudio library sounddevice raises OSError, which importorskip lets through
+    pytest.skip(f"sounddevice unavailable: {e}", allow_module_level=True)
+
+from audiobook_generator import core
+
+
+def test_synthesize_chapters_pushes_sentinel_when_player_fails(monkeypatch):
+    def broken_stream(*args, **kwargs):
+        raise sd.PortAudioError("no output device")
+
+    monkeypatch.setattr(core.sd, 'OutputStream', broken_stream)
+    audio_queue = queue.Queue()
+    with pytest.raises(sd.PortAudioError):
+        core.synthesize_chapters(None, [core.Chapter(1, "One", "Hello.")], audio_queue, play_audio=True)
+    assert audio_queue.get_nowait() is None
+
+
+def test_synthesize_chapters_returns_when_stopped(monkeypatch):
+    def endless(pipeline, text, **kwargs):
+        while True:
+            yield text, text, np.zeros(10, dtype=np.float32)
+
+    monkeypatch.setattr(core, 'synthesize_batched', endless)
+    audio_queue = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    producer = threading.Thread(target=core.synthesize_chapters,
+                                args=(None, [core.Chapter(1, "One", "Hello.")], audio_queue),
+                                kwargs={'stop': stop})
+    producer.start()
+    audio_queue.get(timeout=5)
+    stop.set()
+
+    # At most the queued segments, then the sentinel
+    while audio_queue.get(timeout=5) is not None:
+        pass
+    producer.join(timeout=5)
+    assert not producer.is_alive()
+
+
+@pytest.fixture(scope='module')
+def tiny_model(tmp_path_factory):
+    """Randomly initialised KModel; the decoder's fixed widths pin hidden_dim and style_dim."""
+    torch.manual_seed(0)
+    config = {
+        'vocab': {p: i + 1 for i, p in enumerate("abdefhiklmnoprstuvwz ")},
+        'n_token': 32,
+        'hidden_dim': 512,
+        'style_dim': 128,
+        'n_layer': 1,
+        'max_dur': 50,
+        'dropout': 0.2,
+        'text_encoder_kernel_size': 5,
+        'n_mels': 80,
+        'plbert': {'hidden_size': 64, 'num_attention_heads': 2, 'intermediate_size': 128,
+                   'max_position_embeddings': 512, 'num_hidden_layers': 2, 'dropout': 0.1},
+        'istftnet': {'upsample_kernel_sizes': [20, 12], 'upsample_rates': [10, 6],
+                     'gen_istft_hop_size': 5, 'gen_istft_n_fft': 20,
+                     'resblock_dilation_sizes': [[1, 3, 5], [1, 3, 5], [1, 3, 5]],
+                     'resblock_kernel_sizes': [3, 7, 11], 'upsample_initial_channel': 512},
+    }
+    # An empty checkpoint leaves every module at its random initialisation
+    weights = tmp_path_factory.mktemp('kmodel') / 'empty.pth'
+    torch.save({}, weights)
+    return kokoro.KModel(repo_id='hexgrad/Kokoro-82M', config=config, model=str(weights)).eval()
+
+
+def test_forward_batch_matches_forward_with_tokens(tiny_model, monkeypatch):
+    # The vocoder draws random phase and noise, so reseed before every decode
+    decoder_forward = tiny_model.decoder.forward
+
+    def seeded_forward(*args, **kwargs):
+        torch.manual_seed(0)
+        return decoder_forward(*args, **kwargs)
+
+    monkeypatch.setattr(tiny_model.decoder, 'forward', seeded_forward)
+    phonemes = ["hi w3rld", "o", "a lon sentens wiz mor fonimz"]
+    ref_s = torch.randn(len(phonemes), 256)
+    batched = core._forward_batch(tiny_model, phonemes, ref_s, speed=1.2)
+
+    expected = []
+    for ps, style in zip(phonemes, ref_s):
+        input_ids = torch.LongTensor([[0, *(tiny_model.vocab[p] for p in ps if p in tiny_model.vocab), 0]])
+        audio, _ = tiny_model.forward_with_tokens(input_ids, style.unsqueeze(0), 1.2)
+        expected.append(audio.float())
+    assert [len(audio) for audio in batched] == [len(audio) for audio in expected]
+    for audio, expected_audio in zip(batched, expected):
+        assert torch.allclose(torch.from_numpy(audio), expected_audio, rtol=1e-3, atol=1e-4)
+
+
+class _FakeG2P:
+    """Stands in for an English KPipeline: one segment per space-separated word."""
+
+    model = None
+
+    def __init__(self):
+        self.phonemized = []
+
+    def g2p(self, text):
+        self.phonemized.append(text)
+        return text, text.split()
+
+    def en_tokenize(self, tokens):
+        for token in tokens:
+            yield token, token, None
+
+
+def test_synthesize_batched_caps_windows(monkeypatch):
+    batches = []
+
+    def fake_forward_batch(model, phonemes, ref_s, speed=1):
+        batches.append(len(phonemes))
+        return [np.zeros(len(ps), dtype=np.float32) for ps in phonemes]
+
+    monkeypatch.setattr(core, '_get_voice_pack', lambda pipeline, voice: torch.zeros(510, 1, 256))
+    monkeypatch.setattr(core, '_forward_batch', fake_forward_batch)
+    pipeline = _FakeG2P()
+    # Single line breaks only, as get_text() returns for ordinary XHTML
+    text = '\n'.join(f"line{i} of several words" for i in range(50))
+
+    segments = core.synthesize_batched(pipeline, text, batch_size=4, window_chars=100)
+    gs, _, _ = next(segments)
+    assert gs == "line0"
+    assert len(pipeline.phonemized) == 1
+
+    rest = list(segments)
+    assert [gs for gs, _, _ in rest][-1] == "words"
+    assert len(rest) + 1 == 200
+    assert max(batches) <= 4
+
+
+def test_synthesize_batched_flushes_first_segment_alone(monkeypatch):
+    batches = []
+
+    def fake_forward_batch(model, phonemes, ref_s, speed=1):
+        batches.append(len(phonemes))
+        return [np.zeros(len(ps), dtype=np.float32) for ps in phonemes]
+
+    monkeypatch.setattr(core, '_get_voice_pack', lambda pipeline, voice: torch.zeros(510, 1, 256))
+    monkeypatch.setattr(core, '_forward_batch', fake_forward_batch)
+    text = "One two three. Four five six. Seven eight nine."
+
+    segments = list(core.synthesize_batched(_FakeG2P(), text, batch_size=4, split_pattern=core._SENTENCE_RE,
+                                            flush_first=True))
+    assert len(segments) == 9
+    assert batches == [1, 4, 4]